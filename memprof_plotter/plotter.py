@@ -4,9 +4,12 @@ import argparse
 import github
 import github.Workflow
 import github.WorkflowRun
-import matplotlib.pyplot as plt
+import hashlib
+import itertools
+import json
+import numpy as np
 import os
-import re
+import platformdirs
 import requests
 import sqlite3
 import sys
@@ -14,31 +17,79 @@ import tempfile
 import zipfile
 
 from collections import defaultdict
-from io import BytesIO
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import closing
+from functools import partial
+from pathlib import Path
+from requests.adapters import HTTPAdapter
+from typing import BinaryIO
 
 gh_token = os.environ.get("GH_TOKEN", "BAD_KEY")
 
-get_all_cmds_query: str = "SELECT command,category FROM jobs"
+cache_dir = Path(platformdirs.user_cache_dir("memprof_plotter"))
 
-get_mem_query: str = """
+has_deserialize = hasattr(sqlite3.Connection, "deserialize")
+
+tsp_db_name: str = "tsp_db.sqlite3"
+
+### Downloads are read in chunks and kept in memory until they outgrow the spool size
+download_chunk_size: int = 1 << 16
+download_spool_size: int = 8 << 20
+
+### A (runid, time, rss) row of get_mem_query
+sample_dtype = np.dtype([("runid", np.int64), ("t", np.float32), ("rss", np.float32)])
+
+### Strips spaces and slashes from plot file names
+filename_trans = str.maketrans("", "", " /")
+
+### Series longer than this are thinned to downsample_points before plotting
+downsample_threshold: int = 1000
+downsample_points: int = 800
+
+get_run_cmds_query: str = "SELECT {runid} AS runid, command, category FROM {schema}.jobs"
+
+prepare_mem_script: str = """
+CREATE INDEX IF NOT EXISTS {schema}.idx_memprof_jobid ON memprof(jobid);
+CREATE TABLE {schema}.mintime AS
+SELECT
+    jobid,
+    Min(TIME) AS mt
+FROM
+    {schema}.memprof
+GROUP BY
+    jobid;
+"""
+
+get_run_mem_query: str = """
 SELECT
+    {runid} AS runid,
     command,
     category,
     (time - mt) / 1000000.0 AS t,
-    rss / 1048576.0
+    rss / 1048576.0 AS rss
 FROM
-    memprof
-    JOIN jobs ON memprof.jobid = jobs.id
-    JOIN (
-        SELECT
-            jobid,
-            Min(TIME) AS mt
-        FROM
-            memprof
-        GROUP BY
-            jobid
-    ) AS mintime ON memprof.jobid = mintime.jobid
+    {schema}.memprof AS memprof
+    JOIN {schema}.jobs AS jobs ON memprof.jobid = jobs.id
+    JOIN {schema}.mintime AS mintime ON memprof.jobid = mintime.jobid
+"""
+
+no_mem_query: str = "SELECT NULL AS runid, NULL AS command, NULL AS category, NULL AS t, NULL AS rss LIMIT 0"
+
+get_all_cmds_query: str = "SELECT runid, command, category FROM all_jobs"
+
+get_mem_query: str = """
+SELECT
+    runid,
+    t,
+    rss
+FROM
+    samples
+WHERE
+    category IS ?
+    AND command IS ?
 ORDER BY
+    runid ASC,
     t ASC
 """
 
@@ -55,92 +106,386 @@ class Memprof_Run:
         return f"{self.run_number} - {self.head_branch}"
 
 
-def download_artefact(url: str) -> zipfile.ZipFile | None:
+def positive_int(value: str) -> int:
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {n}")
+    return n
+
+
+def read_manifest(path: str) -> dict | None:
     """
-    PyGithub does not support retrieving artefacts into buffers, so we have to resort
-    to requests
+    Read the manifest recording which runs and options the plots in an output directory
+    were last produced from
     """
-    req = requests.get(
-        url,
-        headers={
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def make_session(pool_size: int) -> requests.Session:
+    """
+    Build a requests session that can be shared between download threads, with
+    enough pooled connections that each thread can reuse its own TCP/TLS connection
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.headers.update(
+        {
             "Accept": "application/vnd.github+json",
             "Authorization": f"Bearer {gh_token}",
             "X-GitHub-Api-Version": "2022-11-28",
-        },
+        }
     )
-    if req.status_code != 200:
+    return session
+
+
+def download_artefact(
+    session: requests.Session, cache: Path | None, run_number: int, url: str | None
+) -> BinaryIO | None:
+    """
+    PyGithub does not support retrieving artefacts into buffers, so we have to resort
+    to requests. The archive is streamed to a spooled temporary file so that large
+    artefacts are not held in memory in full. Artefacts of completed runs never change,
+    so they are streamed into the cache directory (if one is given) instead and read
+    from there on subsequent calls.
+    """
+    cached = cache / f"{run_number}.zip" if cache else None
+    if cached and cached.exists():
+        return open(cached, "rb")
+    buf = None
+    try:
+        with session.get(url, stream=True) as req:
+            if req.status_code != 200:
+                print(f"Failed to download archive {url}")
+                return None
+            if cached:
+                cached.parent.mkdir(parents=True, exist_ok=True)
+                buf = tempfile.NamedTemporaryFile(dir=cached.parent, delete=False)
+            else:
+                buf = tempfile.SpooledTemporaryFile(max_size=download_spool_size)
+            for chunk in req.iter_content(download_chunk_size):
+                buf.write(chunk)
+        if cached:
+            buf.close()
+            os.replace(buf.name, cached)
+            return open(cached, "rb")
+    except (requests.RequestException, OSError):
+        ### Don't leave partial downloads in the cache, and let get_artefacts fall back on older runs
         print(f"Failed to download archive {url}")
+        if buf:
+            buf.close()
+            if cached and os.path.exists(buf.name):
+                os.remove(buf.name)
         return None
-    zf = zipfile.ZipFile(BytesIO(req.content))
-    if "tsp_db.sqlite3" in zf.namelist():
-        return zf
-    else:
-        print("Artefact does not contain required TSP database")
-        return None
+    buf.seek(0)
+    return buf
 
 
-def get_artefacts(
-    nruns: int, workflow: github.Workflow.Workflow, artefact: str, filter: list[str]
-) -> dict[int, Memprof_Run]:
-    runs = {}
+def find_artefacts(
+    workflow: github.Workflow.Workflow, artefact: str, filter: list[str], cache: Path | None
+) -> Iterator[tuple[Memprof_Run, str | None]]:
+    """
+    Lazily yield runs matching the branch filter along with the download url of the
+    requested artefact, most recent first. Runs with a cached artefact are yielded
+    without a url, skipping the artefact listing request.
+    """
     for run in workflow.get_runs(status="success"):
         if filter:
             if run.head_branch not in filter:
                 continue
-        mpr = Memprof_Run(run)
+        if cache and (cache / f"{run.run_number}.zip").exists():
+            yield Memprof_Run(run), None
+            continue
         for gha in run.get_artifacts():
             if gha.name == artefact:
-                artefact_data = download_artefact(gha.archive_download_url)
-                if artefact_data:
-                    mpr.add_artefact(artefact_data)
-                    runs[run.run_number] = mpr
+                yield Memprof_Run(run), gha.archive_download_url
                 break
-        if len(runs) == nruns:
-            break
+
+
+def get_artefacts(
+    nruns: int, candidates: Iterator[tuple[Memprof_Run, str | None]], cache: Path | None
+) -> dict[int, Memprof_Run]:
+    runs = {}
+    if nruns < 1:
+        return runs
+    session = make_session(nruns)
+    with ThreadPoolExecutor(max_workers=nruns) as ex:
+        ### Download in batches so that failed or unusable artefacts are replaced
+        ### by older runs until we have nruns of them or run out of candidates
+        while len(runs) < nruns:
+            batch = list(itertools.islice(candidates, nruns - len(runs)))
+            if not batch:
+                break
+            run_numbers = [mpr.run_number for mpr, _ in batch]
+            urls = [url for _, url in batch]
+            for (mpr, _), data in zip(batch, ex.map(partial(download_artefact, session, cache), run_numbers, urls)):
+                if data is None:
+                    continue
+                zf = zipfile.ZipFile(data)
+                if tsp_db_name not in zf.namelist():
+                    print("Artefact does not contain required TSP database")
+                    data.close()
+                    continue
+                mpr.add_artefact(zf)
+                runs[mpr.run_number] = mpr
+    session.close()
     return runs
 
 
-class Zip_to_sql_conn:
-    def __init__(self, zip: zipfile.ZipFile):
-        self.db = zip.read("tsp_db.sqlite3")
-        self.conn = sqlite3.connect(":memory:")
-        self.tmpfile = None
-        if hasattr(self.conn, "deserialize"):
-            self.conn.deserialize(self.db)
+class Memprof_Series:
+    """
+    Memory samples of a single command across runs, stored as one NaN padded row per run,
+    most recent run first
+    """
+
+    def __init__(self, times: dict[int, np.ndarray], rss: dict[int, np.ndarray]):
+        self.runids = np.array(sorted(times, reverse=True), dtype=np.int64)
+        self.lengths = np.array([len(times[runid]) for runid in self.runids], dtype=np.intp)
+        maxlen = self.lengths.max(initial=0)
+        self.times = np.full((len(self.runids), maxlen), np.nan, dtype=np.float32)
+        self.rss = np.full((len(self.runids), maxlen), np.nan, dtype=np.float32)
+        for i, runid in enumerate(self.runids):
+            self.times[i, : self.lengths[i]] = times[runid]
+            self.rss[i, : self.lengths[i]] = rss[runid]
+
+    def runs(self) -> Iterator[tuple[int, np.ndarray, np.ndarray]]:
+        """Yield the run id and unpadded time and rss samples of each run"""
+        for runid, n, t, r in zip(self.runids, self.lengths, self.times, self.rss):
+            yield int(runid), t[:n], r[:n]
+
+
+def attach_limit() -> int:
+    """Maximum number of databases sqlite allows to be attached to a single connection"""
+    with closing(sqlite3.connect(":memory:")) as conn:
+        return conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+
+
+class Merged_sql_conn:
+    """
+    Attach the TSP database of each run to a single in-memory connection as schema r<run number>,
+    and combine them into the temporary views all_jobs and samples so that every run can be
+    queried at once
+    """
+
+    def __init__(self, runs: list[Memprof_Run]):
+        self.conn = sqlite3.connect(":memory:", uri=True)
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        self.tmpdir = None if has_deserialize else tempfile.TemporaryDirectory()
+        self.mem_conns = []
+        jobs = []
+        samples = []
+        for mpr in runs:
+            schema = f"r{mpr.run_number}"
+            self.attach(mpr.artefact, schema)
+            jobs.append(get_run_cmds_query.format(runid=mpr.run_number, schema=schema))
+            try:
+                self.conn.executescript(prepare_mem_script.format(schema=schema))
+            except sqlite3.OperationalError:
+                ### No such table memprof
+                continue
+            samples.append(get_run_mem_query.format(runid=mpr.run_number, schema=schema))
+        self.conn.execute(f"CREATE TEMP VIEW all_jobs AS {' UNION ALL '.join(jobs)}")
+        self.conn.execute(f"CREATE TEMP VIEW samples AS {' UNION ALL '.join(samples) or no_mem_query}")
+
+    def attach(self, zip: zipfile.ZipFile, schema: str):
+        if has_deserialize:
+            self.conn.execute(f"ATTACH DATABASE ':memory:' AS {schema}")
+            db = zip.read(tsp_db_name)
+            self.conn.deserialize(db, name=schema)
+            del db
         else:
-            self.tmpfile = tempfile.NamedTemporaryFile()
-            self.tmpfile.write(self.db)
-            self.conn = sqlite3.connect(self.tmpfile.name)
+            ### Stream the database out of the archive rather than holding it in memory, then
+            ### page copy it into a shared in-memory database that is kept open until we close
+            path = zip.extract(tsp_db_name, path=os.path.join(self.tmpdir.name, schema))
+            uri = f"file:{schema}_{id(self)}?mode=memory&cache=shared"
+            mem_conn = sqlite3.connect(uri, uri=True)
+            with closing(sqlite3.connect(path)) as src:
+                src.backup(mem_conn)
+            os.remove(path)
+            self.mem_conns.append(mem_conn)
+            self.conn.execute(f"ATTACH DATABASE ? AS {schema}", (uri,))
+        ### We only ever read from (or build indices on) a throwaway copy
+        self.conn.executescript(
+            f"""
+            PRAGMA {schema}.journal_mode=OFF;
+            PRAGMA {schema}.synchronous=OFF;
+            PRAGMA {schema}.cache_size=-65536;
+            """
+        )
 
     def __enter__(self) -> sqlite3.Connection:
         return self.conn
 
     def __exit__(self, type, value, traceback):
         self.conn.close()
-        if self.tmpfile:
-            self.tmpfile.close()
+        for mem_conn in self.mem_conns:
+            mem_conn.close()
+        if self.tmpdir:
+            self.tmpdir.cleanup()
+
+
+def lttb(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """Select n_out points of a series with Largest-Triangle-Three-Buckets downsampling
+
+    The first and last points are always kept. The remaining points are split into n_out - 2
+    buckets, and from each bucket the point forming the largest triangle with the previously
+    selected point and the average of the next bucket is kept. Returns the selected indices.
+    """
+    n = len(x)
+    if n <= n_out:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.intp)
+    idx = np.empty(n_out, dtype=np.intp)
+    idx[0] = 0
+    idx[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nhi = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[hi:nhi].mean()
+        avg_y = y[hi:nhi].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + np.argmax(area)
+        idx[i + 1] = a
+    return idx
+
+
+def setup_matplotlib():
+    """
+    Import matplotlib and configure it for batch PNG output. This is deferred until plotting,
+    as importing matplotlib is slow and memory hungry.
+    """
+    import matplotlib
+
+    ### Only ever writing image files, so skip any interactive backend
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    plt.rcParams["figure.autolayout"] = False
+    plt.rcParams["path.simplify"] = True
+    plt.rcParams["path.simplify_threshold"] = 1.0
+    plt.rcParams["agg.path.chunksize"] = 10000
 
 
-def check_memory_anomaly(category: str, test_name: str, rss: dict[int, list[float]], times: dict[int, list[float]]):
+plot_fig = None
+
+
+def init_plot_worker():
+    """Create the figure that a plotting process reuses for every plot it draws"""
+    global plot_fig
+    setup_matplotlib()
+    import matplotlib.pyplot as plt
+
+    plot_fig = plt.figure()
+
+
+def best_legend_loc(ax, legend, segs: list[np.ndarray]) -> str:
+    """
+    Pick the legend location that covers the fewest of the plotted points and line segments,
+    trying locations in the same order of preference as matplotlib's "best" placement. The
+    legend must already be placed in the upper right corner, which is used to measure its
+    size and its padding from the edges of the axes.
+    """
+    from matplotlib.path import Path as MplPath
+    from matplotlib.transforms import Bbox
+
+    renderer = ax.figure.canvas.get_renderer()
+    box = legend.get_window_extent(renderer)
+    axbox = ax.get_window_extent(renderer)
+    xpad = axbox.x1 - box.x1
+    ypad = axbox.y1 - box.y1
+    x = {
+        "left": axbox.x0 + xpad,
+        "center": axbox.x0 + (axbox.width - box.width) / 2,
+        "right": axbox.x1 - xpad - box.width,
+    }
+    y = {
+        "lower": axbox.y0 + ypad,
+        "center": axbox.y0 + (axbox.height - box.height) / 2,
+        "upper": axbox.y1 - ypad - box.height,
+    }
+    candidates = {
+        "upper right": (x["right"], y["upper"]),
+        "upper left": (x["left"], y["upper"]),
+        "lower left": (x["left"], y["lower"]),
+        "lower right": (x["right"], y["lower"]),
+        "center left": (x["left"], y["center"]),
+        "center right": (x["right"], y["center"]),
+        "lower center": (x["center"], y["lower"]),
+        "upper center": (x["center"], y["upper"]),
+        "center": (x["center"], y["center"]),
+    }
+    paths = [MplPath(ax.transData.transform(seg)) for seg in segs if len(seg)]
+    best = None
+    for loc, (x0, y0) in candidates.items():
+        candidate = Bbox.from_bounds(x0, y0, box.width, box.height)
+        badness = sum(candidate.count_contains(p.vertices) + p.intersects_bbox(candidate, filled=False) for p in paths)
+        if best is None or badness < best[0]:
+            best = (badness, loc)
+        if badness == 0:
+            break
+    return best[1]
+
+
+def plot_one(path: str, title: str, segs: list[np.ndarray], labels: list[str], downsample: bool):
+    """Plot the (time, rss) series of each run of a single command and save to path"""
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import LineCollection
+    from matplotlib.lines import Line2D
+
+    ### Decimate here rather than in the parent so that it runs in parallel too
+    if downsample:
+        segs = [
+            seg[lttb(seg[:, 0], seg[:, 1], downsample_points)] if len(seg) > downsample_threshold else seg
+            for seg in segs
+        ]
+    plot_fig.clear()
+    ax = plot_fig.add_subplot()
+    ### Draw all runs as a single collection so the axes are only autoscaled once
+    cycle_colors = plt.rcParams["axes.prop_cycle"].by_key()["color"]
+    colors = [cycle_colors[i % len(cycle_colors)] for i in range(len(segs))]
+    ax.add_collection(LineCollection(segs, colors=colors))
+    ax.autoscale_view()
+    handles = [Line2D([], [], color=c, label=label) for label, c in zip(labels, colors)]
+    ax.set_xlabel("Time (seconds)")
+    ax.set_ylabel("Memory usage (GB)")
+    ax.set_ylim(ymin=0.0)
+    ax.set_title(title)
+    legend = ax.legend(handles=handles, loc="upper right")
+    ### Matplotlib's "best" legend placement ignores the paths of a LineCollection, so choose
+    ### the position ourselves and redraw the legend there if it isn't the default
+    loc = best_legend_loc(ax, legend, segs)
+    if loc != "upper right":
+        legend.remove()
+        ax.legend(handles=handles, loc=loc)
+    plot_fig.savefig(path, dpi=100, bbox_inches=None, pad_inches=0)
+
+
+def check_memory_anomaly(category: str, test_name: str, series: Memprof_Series):
     """Check for unusually high memory usage in the latest test
 
     For every test with a >60 second runtime, compare the maximum memory usage of the most recent
     test and issue a warning via github annotation if the memory usage is more than 20% above the
     average of the n previous runs.
     """
-    if len(rss) == 1:
+    if len(series.runids) == 1:
         return
 
-    if any([max(tl or [0.0,]) <= 60.0 for tl in times.values()]):
+    if (series.lengths == 0).any() or (np.nanmax(series.times, axis=1) <= 60.0).any():
         return
 
-    max_mems = {i: max(rl) for i, rl in rss.items()}
-    latest_run_no = max(max_mems.keys())
+    max_mems = np.nanmax(series.rss, axis=1)
+    latest = np.argmax(series.runids)
+    latest_run_no = series.runids[latest]
 
-    avg_mem = sum([m for i, m in max_mems.items() if i != latest_run_no]) / (len(max_mems) - 1)
-    if max_mems[latest_run_no] > 1.2 * avg_mem:
+    avg_mem = np.delete(max_mems, latest).mean()
+    if max_mems[latest] > 1.2 * avg_mem:
         print(
-            f"::warning title=High Memory Usage::Latest run of {category}: {test_name} ({latest_run_no}) has memory usage over 20% higher than the average for this test {max_mems[latest_run_no]:.2f}GB > {avg_mem:.2f}GB"
+            f"::warning title=High Memory Usage::Latest run of {category}: {test_name} ({latest_run_no}) has memory usage over 20% higher than the average for this test {max_mems[latest]:.2f}GB > {avg_mem:.2f}GB"
         )
 
 
@@ -155,7 +500,7 @@ def main():
         "-o", "--outdir", required=False, type=str, default="memprof_plots", help="top directory for output plots"
     )
     parser.add_argument(
-        "-n", "--nruns", required=False, type=int, default=5, help="Number of successful runs to gather"
+        "-n", "--nruns", required=False, type=positive_int, default=5, help="Number of successful runs to gather"
     )
     parser.add_argument(
         "-r", "--repo", required=False, type=str, default="g-adopt/g-adopt", help="Repository to gather artefacts from"
@@ -179,6 +524,18 @@ def main():
         default="",
         help="Comma separated list of branch names to filter runs on",
     )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="Do not read or write downloaded artefacts in the local cache"
+    )
+    parser.add_argument(
+        "--no-downsample", action="store_true", help="Plot every memprof sample instead of a decimated series"
+    )
+    parser.add_argument(
+        "--force-refresh",
+        action="store_true",
+        help="Redraw every plot, rather than skipping redrawing those already drawn from the same runs, options and "
+        "plotter version (artefacts are always fetched and ingested)",
+    )
 
     ns = parser.parse_args(sys.argv[1:])
 
@@ -189,46 +546,96 @@ def main():
 
     filter = ns.filter.split(",") if ns.filter else []
 
-    runs = get_artefacts(ns.nruns, repo.get_workflow(ns.workflow), ns.artefact, filter)
+    cache = None if ns.no_cache else cache_dir / ns.repo / ns.workflow / ns.artefact
+
+    candidates = find_artefacts(repo.get_workflow(ns.workflow), ns.artefact, filter, cache)
+
+    runs = get_artefacts(ns.nruns, candidates, cache)
+
+    ### Plots made from the same runs, options and plotting code as recorded in the manifest
+    ### don't need redrawing, as long as they are still there
+    manifest_path = os.path.join(ns.outdir, ".manifest.json")
+    manifest = {
+        "options": {
+            "repo": ns.repo,
+            "workflow": ns.workflow,
+            "artefact": ns.artefact,
+            "filter": filter,
+            "nruns": ns.nruns,
+            "downsample": not ns.no_downsample,
+        },
+        "plotter": hashlib.sha256(Path(__file__).read_bytes()).hexdigest(),
+        "runs": list(runs),
+    }
+    up_to_date = not ns.force_refresh and read_manifest(manifest_path) == manifest
+    if not up_to_date and os.path.exists(manifest_path):
+        ### Plots are about to be overwritten, so the old manifest must not survive an interrupted run
+        os.remove(manifest_path)
 
     d_times = defaultdict(dict)
     d_rss = defaultdict(dict)
     d_cat = {}
     d_names = {}
 
-    for runid, mpr in runs.items():
-        with Zip_to_sql_conn(mpr.artefact) as conn:
+    ### Query as many runs at once as can be attached to a single connection
+    all_runs = list(runs.values())
+    batch_size = attach_limit()
+    for batch in (all_runs[i : i + batch_size] for i in range(0, len(all_runs), batch_size)):
+        with Merged_sql_conn(batch) as conn:
             cur = conn.cursor()
-            cur.execute(get_all_cmds_query)
-            for cmd, cat in cur.fetchall():
-                d_cat[f"{cat}_{cmd}"] = cat or "other"
-                d_times[f"{cat}_{cmd}"][runid] = []
-                d_rss[f"{cat}_{cmd}"][runid] = []
-                d_names[f"{cat}_{cmd}"] = cmd
-
-            try:
-                cur.execute(get_mem_query)
-            except sqlite3.OperationalError:
-                ### No such table memprof
-                continue
-            for cmd, cat, time, rss in cur.fetchall():
-                d_times[f"{cat}_{cmd}"][runid].append(time)
-                d_rss[f"{cat}_{cmd}"][runid].append(rss)
-
-    for k, v in d_rss.items():
-        check_memory_anomaly(d_cat[k], k, v, d_times[k])
-        os.makedirs(f"{ns.outdir}/{d_cat[k]}", exist_ok=True)
-        fig, ax = plt.subplots()
-        for runid in runs:
-            if runid in v:
-                ax.plot(d_times[k][runid], v[runid], label=f"Run {runs[runid]}")
-        ax.set_xlabel("Time (seconds)")
-        ax.set_ylabel("Memory usage (GB)")
-        ax.set_ylim(ymin=0.0)
-        ax.set_title(d_names[k])
-        ax.legend()
-        fig.savefig(f"{ns.outdir}/{d_cat[k]}/{re.sub('[ /]', '', k)}.png")
-        plt.close(fig)
+            key_for = {}
+            for runid, cmd, cat in cur.execute(get_all_cmds_query).fetchall():
+                if (cmd, cat) not in key_for:
+                    key_for[(cmd, cat)] = f"{cat}_{cmd}"
+                key = key_for[(cmd, cat)]
+                if key not in d_cat:
+                    d_cat[key] = cat or "other"
+                    d_names[key] = cmd
+                d_times[key][runid] = np.empty(0, dtype=np.float32)
+                d_rss[key][runid] = np.empty(0, dtype=np.float32)
+
+            for (cmd, cat), key in key_for.items():
+                ### Stream rows straight into the array rather than materialising a list of tuples
+                samples = np.fromiter(cur.execute(get_mem_query, (cat, cmd)), dtype=sample_dtype)
+                runids, starts = np.unique(samples["runid"], return_index=True)
+                for runid, times, rss in zip(
+                    runids, np.split(samples["t"], starts[1:]), np.split(samples["rss"], starts[1:])
+                ):
+                    d_times[key][int(runid)] = times
+                    d_rss[key][int(runid)] = rss
+
+    ### Repack each command's samples into contiguous padded arrays
+    d_series = {k: Memprof_Series(d_times[k], d_rss[k]) for k in d_rss}
+    del d_times, d_rss
+
+    for cat in set(d_cat.values()):
+        os.makedirs(os.path.join(ns.outdir, cat), exist_ok=True)
+
+    labels = {runid: f"Run {mpr}" for runid, mpr in runs.items()}
+    paths, titles, run_segs, run_labels = [], [], [], []
+    for k, series in d_series.items():
+        check_memory_anomaly(d_cat[k], k, series)
+        path = os.path.join(ns.outdir, d_cat[k], f"{k.translate(filename_trans)}.png")
+        if up_to_date and os.path.exists(path):
+            continue
+        paths.append(path)
+        titles.append(d_names[k])
+        run_segs.append([np.column_stack([times, rss]) for _, times, rss in series.runs()])
+        run_labels.append([labels[runid] for runid in series.runids])
+
+    if paths:
+        ### Import matplotlib once here so forked workers inherit it, rather than each importing it
+        setup_matplotlib()
+
+        ### Every plot is independent, so render them across all cores, but don't start more
+        ### workers (each building its own figure) than there are plots to draw
+        workers = max(1, min(os.cpu_count() or 1, len(paths)))
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_plot_worker) as ex:
+            list(ex.map(plot_one, paths, titles, run_segs, run_labels, itertools.repeat(not ns.no_downsample)))
+
+    os.makedirs(ns.outdir, exist_ok=True)
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
 
 
 if __name__ == "__main__":